@@ -1,26 +1,221 @@
 #!/usr/bin/env python3
+import argparse
+import datetime
+import email.utils
+import errno
+import io
 import os
+import select
+import shlex
 import signal
 import subprocess
 import time
 import socket
-from http.server import SimpleHTTPRequestHandler, HTTPServer
+import stat
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
 
+try:
+    import psutil  # optional: avoids spawning lsof to find/kill port owners
+except ImportError:
+    psutil = None
+
+# Defaults, overridable with DEV_* environment variables or command-line flags
 PORT = 8888
-BROWSER = 'safari'  # or 'chrome' or 'default'
-PRIVATE_MODE = False  # Set to True for private browsing (Safari only)
-HOST = '0.0.0.0'
-CUSTOM_DOMAIN = 'dev.local'  # Change to your preferred domain
+BROWSERS = ('safari', 'chrome', 'default')
+BROWSER = 'safari'
+PRIVATE_MODE = False  # Private browsing (Safari only)
+HOST = '::'  # dual-stack: accepts IPv4 and IPv6 clients
+IPV4_HOST = '0.0.0.0'  # used when IPv6 is unavailable
+CUSTOM_DOMAIN = 'dev.local'
+
+class DevServer(ThreadingHTTPServer):
+    """Threaded server so a held-open keep-alive connection doesn't block others"""
+    address_family = socket.AF_INET6
+    daemon_threads = True
+    request_queue_size = 128
+
+    def server_bind(self):
+        # One listener for both families, matching the 127.0.0.1 and ::1
+        # entries add_hosts_entry writes for the custom domain
+        if self.address_family == socket.AF_INET6:
+            self.socket.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 0)
+        super().server_bind()
+
+    def __init__(self, *args, **kwargs):
+        # Set once serve_forever starts accepting, so open_browser can wait on it
+        self.ready = threading.Event()
+        super().__init__(*args, **kwargs)
+
+    def serve_forever(self, poll_interval=0.5):
+        self.ready.set()
+        super().serve_forever(poll_interval)
+
+class IPv4DevServer(DevServer):
+    """Fallback for hosts with IPv6 disabled"""
+    address_family = socket.AF_INET
+
+# Bodies of small static files, served from memory until their mtime or size
+# changes: {path: ((mtime_ns, size), body, content_type)}
+_ASSET_CACHE = {}
+MAX_CACHED_ASSET_SIZE = 64 * 1024
 
 class NoCacheHandler(SimpleHTTPRequestHandler):
+    # HTTP/1.1 keeps connections alive between asset requests
+    protocol_version = 'HTTP/1.1'
+    # TCP_NODELAY: headers go out in one write, so Nagle only adds latency
+    disable_nagle_algorithm = True
+
+    # Pre-encoded header lines, appended to the header buffer as-is instead
+    # of being formatted by send_header() on every response
+    _KEEP_ALIVE_HEADER = b"Connection: keep-alive\r\n"
+    # no-cache rather than no-store: browsers keep the file but revalidate it
+    # on every load, which the ETag check in send_head answers with a 304
+    _NOCACHE_HEADERS = (
+        b"Cache-Control: no-cache, must-revalidate, max-age=0\r\n"
+        b"Pragma: no-cache\r\n"
+        b"Expires: 0\r\n"
+    )
+
+    _etag = None
+    _content_length = None
+
+    def handle_one_request(self):
+        # The handler lives for the whole keep-alive connection, so drop the
+        # previous response's ETag before errors like 501/414 can reuse it
+        self._etag = None
+        self._content_length = None
+        super().handle_one_request()
+
+    def send_error(self, code, message=None, explain=None):
+        # Error bodies must never carry a file's ETag, e.g. when open() fails
+        # in the base send_head after the ETag was computed
+        self._etag = None
+        super().send_error(code, message, explain)
+
+    def send_header(self, keyword, value):
+        if keyword.lower() == 'content-length':
+            self._content_length = int(value)
+        super().send_header(keyword, value)
+
+    def send_head(self):
+        path = self.translate_path(self.path)
+        try:
+            st = os.stat(path)
+        except OSError:
+            return super().send_head()
+        if path.endswith('/') or not stat.S_ISREG(st.st_mode):
+            return super().send_head()
+        
+        self._etag = f'"{st.st_mtime_ns:x}-{st.st_size:x}"'
+        if_none_match = self.headers.get('If-None-Match')
+        if (self._etag_matches(if_none_match)
+                or (if_none_match is None and self._not_modified_since(st))):
+            self.send_response(HTTPStatus.NOT_MODIFIED)
+            self.end_headers()
+            return None
+        
+        # Same (mtime, size) pair as the ETag, so a body never outlives its tag
+        version = (st.st_mtime_ns, st.st_size)
+        cached = _ASSET_CACHE.get(path)
+        if cached is None or cached[0] != version:
+            if st.st_size > MAX_CACHED_ASSET_SIZE:
+                return super().send_head()
+            try:
+                with open(path, 'rb') as f:
+                    body = f.read()
+            except OSError:
+                self._etag = None
+                return super().send_head()
+            cached = (version, body, self.guess_type(path))
+            _ASSET_CACHE[path] = cached
+        
+        _, body, content_type = cached
+        self.send_response(HTTPStatus.OK)
+        self.send_header('Content-type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Last-Modified', self.date_time_string(st.st_mtime))
+        self.end_headers()
+        return io.BytesIO(body)
+
+    def _not_modified_since(self, st):
+        """Check If-Modified-Since against the file's mtime, as the base class does"""
+        ims = self.headers.get('If-Modified-Since')
+        if not ims:
+            return False
+        try:
+            since = email.utils.parsedate_to_datetime(ims)
+        except (TypeError, IndexError, OverflowError, ValueError):
+            return False
+        if since.tzinfo is None:
+            since = since.replace(tzinfo=datetime.timezone.utc)
+        if since.tzinfo is not datetime.timezone.utc:
+            return False
+        last_modified = datetime.datetime.fromtimestamp(st.st_mtime, datetime.timezone.utc)
+        return last_modified.replace(microsecond=0) <= since
+
+    def _etag_matches(self, if_none_match):
+        """Check an If-None-Match header value against the current ETag"""
+        if not if_none_match:
+            return False
+        for tag in if_none_match.split(','):
+            tag = tag.strip()
+            if tag == '*' or tag.removeprefix('W/') == self._etag:
+                return True
+        return False
+
+    def copyfile(self, source, outputfile):
+        if outputfile is not self.wfile:
+            return super().copyfile(source, outputfile)
+        if isinstance(source, io.BytesIO):
+            # Cached asset or directory listing: already in memory, one write
+            self.wfile.write(source.getbuffer())
+            return
+        # socket.sendfile uses zero-copy os.sendfile() for real files. Send
+        # exactly the advertised length: a file growing mid-response must not
+        # spill into the next keep-alive response, and one that shrank leaves
+        # the framing broken, so drop the connection
+        self.wfile.flush()
+        sent = self.connection.sendfile(source, count=self._content_length)
+        if self._content_length is not None and sent < self._content_length:
+            self.close_connection = True
+
     def end_headers(self):
-        self.send_header('Cache-Control', 'no-store, no-cache, must-revalidate, max-age=0')
-        self.send_header('Pragma', 'no-cache')
-        self.send_header('Expires', '0')
+        if self.request_version != 'HTTP/0.9':
+            if not self.close_connection:
+                self._headers_buffer.append(self._KEEP_ALIVE_HEADER)
+            if self._etag:
+                self._headers_buffer.append(f"ETag: {self._etag}\r\n".encode('latin-1'))
+            self._headers_buffer.append(self._NOCACHE_HEADERS)
         super().end_headers()
 
+_LOCAL_IP = None
+
 def get_local_ip():
     """Get the machine's local IP address"""
+    global _LOCAL_IP
+    if _LOCAL_IP is None:
+        _LOCAL_IP = _interface_ip() or _routed_ip()
+    return _LOCAL_IP
+
+def _interface_ip():
+    """First non-loopback IPv4 address on an interface that is up, via psutil"""
+    if psutil is None:
+        return None
+    stats = psutil.net_if_stats()
+    for name, addrs in psutil.net_if_addrs().items():
+        if name not in stats or not stats[name].isup:
+            continue
+        for addr in addrs:
+            if (addr.family == socket.AF_INET
+                    and not addr.address.startswith(('127.', '169.254.'))):
+                return addr.address
+    return None
+
+def _routed_ip():
+    """Source address the kernel would route external traffic from"""
     try:
         s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         s.connect(("8.8.8.8", 80))
@@ -30,54 +225,165 @@ def get_local_ip():
     except Exception:
         return "127.0.0.1"
 
+def _pids_on_port(port):
+    """Return the PIDs of processes listening on the given TCP port"""
+    # Only listeners: clients such as a browser holding keep-alive connections
+    # to the port must not be killed
+    if psutil is not None:
+        try:
+            return {c.pid for c in psutil.net_connections(kind='tcp')
+                    if c.status == psutil.CONN_LISTEN
+                    and c.laddr and c.laddr.port == port and c.pid}
+        except psutil.AccessDenied:
+            # macOS only lists other users' sockets to root; fall back to lsof
+            pass
+    
+    result = subprocess.run(
+        ['lsof', '-ti', f'tcp:{port}', '-sTCP:LISTEN'],
+        capture_output=True,
+        text=True
+    )
+    return {int(pid) for pid in result.stdout.split()}
+
+def _wait_for_exit(pids, timeout):
+    """Block until the given processes exit; return the PIDs still alive at timeout"""
+    deadline = time.monotonic() + timeout
+    if hasattr(select, 'kqueue'):
+        return _wait_kqueue(pids, deadline)
+    alive = _wait_pidfd(pids, deadline) if hasattr(os, 'pidfd_open') else None
+    if alive is not None:
+        return alive
+    
+    # No exit notification available: poll for the processes going away
+    alive = set(pids)
+    while alive and time.monotonic() < deadline:
+        for pid in list(alive):
+            try:
+                os.kill(pid, 0)
+            except ProcessLookupError:
+                alive.discard(pid)
+        if alive:
+            time.sleep(0.05)
+    return alive
+
+def _wait_kqueue(pids, deadline):
+    """macOS/BSD: wait for EVFILT_PROC NOTE_EXIT events"""
+    kq = select.kqueue()
+    try:
+        alive = set()
+        for pid in pids:
+            event = select.kevent(pid, select.KQ_FILTER_PROC,
+                                  select.KQ_EV_ADD | select.KQ_EV_ONESHOT, select.KQ_NOTE_EXIT)
+            try:
+                kq.control([event], 0)
+                alive.add(pid)
+            except ProcessLookupError:
+                pass  # already gone
+        while alive and (remaining := deadline - time.monotonic()) > 0:
+            for event in kq.control(None, len(alive), remaining):
+                alive.discard(event.ident)
+        return alive
+    finally:
+        kq.close()
+
+def _wait_pidfd(pids, deadline):
+    """Linux: poll pidfds, which become readable when the process exits.
+    Returns None if pidfd_open isn't supported by the kernel."""
+    poller = select.poll()
+    fds = {}
+    try:
+        for pid in pids:
+            try:
+                fd = os.pidfd_open(pid)
+            except ProcessLookupError:
+                continue  # already gone
+            except OSError:
+                return None
+            fds[fd] = pid
+            poller.register(fd, select.POLLIN)
+        while fds and (remaining := deadline - time.monotonic()) > 0:
+            for fd, _ in poller.poll(remaining * 1000):
+                poller.unregister(fd)
+                os.close(fd)
+                del fds[fd]
+        return set(fds.values())
+    finally:
+        for fd in fds:
+            os.close(fd)
+
 def kill_port(port):
     """Kill any process using the specified port"""
     try:
-        result = subprocess.run(
-            ['lsof', '-ti', f':{port}'],
-            capture_output=True,
-            text=True
-        )
+        pids = _pids_on_port(port)
         
-        if result.stdout.strip():
-            pids = result.stdout.strip().split('\n')
+        if pids:
             for pid in pids:
                 try:
-                    os.kill(int(pid), signal.SIGKILL)
+                    os.kill(pid, signal.SIGKILL)
                     print(f"Killed process {pid} on port {port}")
-                except (ProcessLookupError, ValueError):
+                except ProcessLookupError:
                     pass
             
             print(f"Waiting for port {port} to be released...")
-            time.sleep(1)
-            
-            for i in range(5):
-                result = subprocess.run(
-                    ['lsof', '-ti', f':{port}'],
-                    capture_output=True,
-                    text=True
-                )
-                if not result.stdout.strip():
-                    print(f"Port {port} is now free")
-                    break
-                time.sleep(0.5)
+            alive = _wait_for_exit(pids, timeout=2.5)
+            if alive:
+                print(f"⚠️  Port {port} still held by PID(s) {', '.join(map(str, sorted(alive)))}")
+            else:
+                print(f"Port {port} is now free")
         else:
             print(f"Port {port} is already free")
             
     except Exception as e:
         print(f"Error killing port {port}: {e}")
 
+HOSTS_FILE = '/etc/hosts'
+DNS_FLUSH_COMMANDS = 'dscacheutil -flushcache 2>/dev/null; killall -HUP mDNSResponder 2>/dev/null'
+
+# Loopback addresses a hosts row must map the domain to, by family
+LOOPBACK_FAMILIES = {'127.0.0.1': 'ipv4', '::1': 'ipv6'}
+
+# (mtime_ns, {hostname: {'ipv4', 'ipv6'}}) for the last parse of HOSTS_FILE
+_HOSTS_CACHE = (None, {})
+
+def _load_hosts():
+    """Parse HOSTS_FILE into a hostname -> loopback families map, cached by mtime"""
+    global _HOSTS_CACHE
+    mtime = os.stat(HOSTS_FILE).st_mtime_ns
+    if _HOSTS_CACHE[0] == mtime:
+        return _HOSTS_CACHE[1]
+    
+    hosts = {}
+    # Hostnames are ASCII; don't let a stray non-UTF-8 byte in a comment fail the parse
+    with open(HOSTS_FILE, 'r', encoding='utf-8', errors='replace') as f:
+        for line in f:
+            fields = line.split('#', 1)[0].split()
+            family = LOOPBACK_FAMILIES.get(fields[0]) if len(fields) >= 2 else None
+            if family is None:
+                continue
+            for name in fields[1:]:
+                hosts.setdefault(name, set()).add(family)
+    
+    _HOSTS_CACHE = (mtime, hosts)
+    return hosts
+
 def check_hosts_entry(domain):
     """Check if domain is configured in /etc/hosts for both IPv4 and IPv6"""
     try:
-        with open('/etc/hosts', 'r') as f:
-            content = f.read()
-            has_ipv4 = f'127.0.0.1' in content and domain in content
-            has_ipv6 = f'::1' in content and domain in content
-            return has_ipv4, has_ipv6
-    except:
+        families = _load_hosts().get(domain, ())
+        return 'ipv4' in families, 'ipv6' in families
+    except OSError:
         return False, False
 
+def _sudo_problem():
+    """Return why sudo can't run without a password prompt, or None if it can"""
+    try:
+        result = subprocess.run(['sudo', '-n', 'true'], capture_output=True)
+    except FileNotFoundError:
+        return "sudo is not installed"
+    except OSError as e:
+        return f"sudo could not be run ({e})"
+    return None if result.returncode == 0 else "sudo needs a password"
+
 def add_hosts_entry(domain):
     """Add domain to /etc/hosts if not present (both IPv4 and IPv6)"""
     has_ipv4, has_ipv6 = check_hosts_entry(domain)
@@ -96,18 +402,32 @@ def add_hosts_entry(domain):
         entries_to_add.append(f"::1             {domain}")
         print(f"⚠️  IPv6 entry for '{domain}' missing")
     
+    # sudo would block on a password prompt we can't show, so bail out early
+    sudo_problem = _sudo_problem() if entries_to_add else None
+    if sudo_problem:
+        print(f"✗ {sudo_problem}; add these lines to {HOSTS_FILE} manually:")
+        for entry in entries_to_add:
+            print(f"    {entry}")
+        return False
+    
     if entries_to_add:
-        print(f"Adding entries to /etc/hosts (requires sudo)...")
+        print(f"Adding entries to /etc/hosts and flushing DNS cache (requires sudo)...")
         
         try:
-            # Create a temporary file with entries
+            # One sudo call appends the entries and flushes the DNS cache; the
+            # flush commands are macOS-only, so their failure is not fatal
             entries_text = '\n'.join(entries_to_add)
-            cmd = f"echo '{entries_text}' | sudo tee -a /etc/hosts"
-            result = subprocess.run(cmd, shell=True, capture_output=True, text=True)
+            script = (
+                f"printf '%s\\n' {shlex.quote(entries_text)} >> {HOSTS_FILE} || exit 1; "
+                f"{DNS_FLUSH_COMMANDS}; exit 0"
+            )
+            result = subprocess.run(['sudo', 'sh', '-c', script], capture_output=True, text=True)
             
             if result.returncode == 0:
+                added = [family for family, present in (('IPv4', has_ipv4), ('IPv6', has_ipv6)) if not present]
                 print(f"✓ Successfully added '{domain}' to /etc/hosts")
-                print(f"  Added: {', '.join(['IPv4' if not has_ipv4 else '', 'IPv6' if not has_ipv6 else ''])}")
+                print(f"  Added: {', '.join(added)}")
+                print("✓ DNS cache flushed")
                 return True
             else:
                 print(f"✗ Failed to add domain to /etc/hosts")
@@ -118,58 +438,110 @@ def add_hosts_entry(domain):
     
     return True
 
-def flush_dns_cache():
-    """Flush DNS cache to ensure changes take effect"""
-    try:
-        print("Flushing DNS cache...")
-        subprocess.run(['sudo', 'dscacheutil', '-flushcache'], capture_output=True)
-        subprocess.run(['sudo', 'killall', '-HUP', 'mDNSResponder'], capture_output=True)
-        print("✓ DNS cache flushed")
-    except Exception as e:
-        print(f"⚠️  Could not flush DNS cache: {e}")
+def _spawn(*argv):
+    """Run a command with posix_spawn, skipping subprocess' fork, and wait for it"""
+    pid = os.posix_spawnp(argv[0], argv, os.environ)
+    return os.waitstatus_to_exitcode(os.waitpid(pid, 0)[1])
+
+SAFARI_PRIVATE_APPLESCRIPT = '''
+tell application "Safari"
+    activate
+    tell application "System Events"
+        keystroke "n" using {{command down, shift down}}
+    end tell
+    delay 0.5
+    set URL of document 1 to "{url}"
+end tell
+'''
 
-def open_browser(url, browser='default', private=False):
-    """Open URL in specified browser"""
-    time.sleep(0.5)
+def open_browser(url, browser='default', private=False, ready=None):
+    """Open URL in specified browser, once the ready event (if given) is set"""
+    if ready is not None:
+        ready.wait()
     
     if browser == 'safari':
         if private:
-            applescript = f'''
-            tell application "Safari"
-                activate
-                tell application "System Events"
-                    keystroke "n" using {{command down, shift down}}
-                end tell
-                delay 0.5
-                set URL of document 1 to "{url}"
-            end tell
-            '''
-            subprocess.run(['osascript', '-e', applescript])
+            applescript = SAFARI_PRIVATE_APPLESCRIPT.format(url=url)
+            _spawn('osascript', '-e', applescript)
             print("🔒 Opened in Safari Private Browsing")
         else:
-            subprocess.run(['open', '-a', 'Safari', url])
+            _spawn('open', '-a', 'Safari', url)
             
     elif browser == 'chrome':
         if private:
             print("⚠️  Chrome doesn't support opening in incognito via command line")
             print("   Opening in regular mode. Use Safari for private browsing support.")
-        subprocess.run(['open', '-a', 'Google Chrome', url])
+        _spawn('open', '-a', 'Google Chrome', url)
         
     else:
         import webbrowser
         webbrowser.open(url)
 
+def start_server(port, force=False):
+    """Bind the dev server, only clearing the port if something still holds it"""
+    if force:
+        kill_port(port)
+    
+    # allow_reuse_address already sets SO_REUSEADDR, so a socket left in
+    # TIME_WAIT by the previous run doesn't block the bind
+    try:
+        return _bind_server(port)
+    except OSError as e:
+        if e.errno != errno.EADDRINUSE:
+            raise
+    
+    print(f"Port {port} is in use, freeing it...")
+    kill_port(port)
+    return _bind_server(port)
+
+def _bind_server(port):
+    """Bind a dual-stack server, falling back to IPv4 only if IPv6 is disabled"""
+    try:
+        return DevServer((HOST, port), NoCacheHandler)
+    except OSError as e:
+        if e.errno not in (errno.EAFNOSUPPORT, errno.EADDRNOTAVAIL):
+            raise
+    return IPv4DevServer((IPV4_HOST, port), NoCacheHandler)
+
 if __name__ == '__main__':
-    kill_port(PORT)
+    parser = argparse.ArgumentParser(description='Local no-cache dev server')
+    # String defaults go through type=, so a bad DEV_PORT is reported like a bad --port
+    parser.add_argument('--port', type=int, default=os.environ.get('DEV_PORT', str(PORT)),
+                        help='port to listen on (default: %(default)s, env DEV_PORT)')
+    parser.add_argument('--browser', choices=BROWSERS, default=os.environ.get('DEV_BROWSER', BROWSER),
+                        help='browser to open (default: %(default)s, env DEV_BROWSER)')
+    parser.add_argument('--private', action=argparse.BooleanOptionalAction,
+                        default=os.environ.get('DEV_PRIVATE', str(int(PRIVATE_MODE))) == '1',
+                        help='open a private browsing window, Safari only (env DEV_PRIVATE=1)')
+    parser.add_argument('--domain', default=os.environ.get('DEV_DOMAIN', CUSTOM_DOMAIN),
+                        help='custom domain added to /etc/hosts (default: %(default)s, env DEV_DOMAIN)')
+    parser.add_argument('--force', action='store_true',
+                        help='kill whatever is listening on the port before binding')
+    args = parser.parse_args()
+    # argparse doesn't check defaults against choices, so validate DEV_BROWSER here
+    if args.browser not in BROWSERS:
+        parser.error(f"DEV_BROWSER: invalid choice: {args.browser!r} (choose from {', '.join(BROWSERS)})")
+    if not 1 <= args.port <= 65535:
+        parser.error(f"argument --port: must be between 1 and 65535, got {args.port}")
+    PORT, BROWSER, PRIVATE_MODE, CUSTOM_DOMAIN = args.port, args.browser, args.private, args.domain
     
-    # Check and add hosts entry if needed
-    hosts_configured = add_hosts_entry(CUSTOM_DOMAIN)
+    # Binding, hosts setup and IP lookup are independent, so overlap them
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        server_future = pool.submit(start_server, PORT, args.force)
+        ip_future = pool.submit(get_local_ip)
+        
+        # Check and add hosts entry if needed (flushes DNS cache when it does)
+        hosts_configured = pool.submit(add_hosts_entry, CUSTOM_DOMAIN).result()
     
-    # Flush DNS cache if we added new entries
-    if hosts_configured:
-        flush_dns_cache()
+    try:
+        server = server_future.result()
+    except OSError as e:
+        if e.errno == errno.EADDRINUSE:
+            print(f"\nPort {PORT} is still in use. Stop the process holding it and try again")
+            raise SystemExit(1)
+        raise
     
-    local_ip = get_local_ip()
+    local_ip = ip_future.result()
     
     print(f"\n{'='*60}")
     print(f"Starting server on port {PORT}")
@@ -192,18 +564,8 @@ if __name__ == '__main__':
     print("Press Ctrl+C to stop\n")
     
     try:
-        from threading import Thread
-        server = HTTPServer((HOST, PORT), NoCacheHandler)
-        
-        Thread(target=lambda: open_browser(url, BROWSER, PRIVATE_MODE), daemon=True).start()
+        threading.Thread(target=open_browser, args=(url, BROWSER, PRIVATE_MODE, server.ready), daemon=True).start()
         
         server.serve_forever()
     except KeyboardInterrupt:
         print("\nServer stopped")
-    except OSError as e:
-        if e.errno == 48:
-            print(f"\nPort {PORT} is still in use. Trying force kill...")
-            subprocess.run(f'lsof -ti:{PORT} | xargs kill -9', shell=True)
-            print("Please run the script again")
-        else:
-            raise